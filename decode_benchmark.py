@@ -0,0 +1,41 @@
+import json
+import sys
+import time
+import tools
+
+
+def decode_benchmark(payload_file: str, keys: tuple = (), number: int = 100):
+    """ Compare json decoding of a recorded response body
+
+    :param payload_file: file with raw response body, set RequestHandler.payload_dir to record them
+    :param keys: path of keys to the needed part of response, as RequestHandler.decode gets it
+    :param number: number of decodes for each path
+    :return: dict {decode path: seconds per decode}
+    """
+    with open(payload_file, 'rb') as payload:
+        content = payload.read()
+
+    def text_decode():  # Previous path: json.loads(r.text)[key]...
+        data = json.loads(content.decode('utf-8'))
+        for key in keys:
+            data = data[key]
+        return data
+
+    paths = {'json.loads(text)': text_decode,
+             f"decode_json ({'orjson' if tools.orjson else 'json'})": lambda: tools.decode_json(content, *keys)}
+    out = dict()
+    for path, decode in paths.items():
+        start = time.perf_counter()
+        for _ in range(number):
+            decode()
+        out[path] = (time.perf_counter() - start) / number
+        print(f"{path}: {out[path] * 1000:.3f} ms")
+    return out
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("usage: python decode_benchmark.py payload_file [key ...]\n"
+              "example: python decode_benchmark.py twins.json data axies")
+        sys.exit(1)
+    decode_benchmark(sys.argv[1], tuple(sys.argv[2:]))
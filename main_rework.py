@@ -7,8 +7,11 @@ from credentials import api_token, sample_user_id
 import logging
 from agp_py import AxieGene
 import tools
+from price_history import PriceHistory, build_signature, team_signature
 from collections import Counter
 import time
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 pd.options.mode.chained_assignment = None
 logging.basicConfig(level=logging.INFO, filename='logs_rework.log', format='%(asctime)s :: %(levelname)s :: %(message)s')
@@ -18,6 +21,7 @@ tools.erase_log()
 parts = ['eyes', 'mouth', 'ears', 'horn', 'back', 'tail']
 
 class AxieUser:
+    leaderboard_cache = dict()  # {(offset, limit): (fetch time, [(rank, userID)...])}
 
     def __init__(self, user_id: int = sample_user_id, axie_ids: list = None):
         self.user_id = user_id
@@ -46,7 +50,7 @@ class AxieUser:
             'userID': self.user_id
         }
         r = self.request_handler.getRequest(url, params, headers)
-        return [axie['id'] for axie in json.loads(r.text)['_items']]
+        return [axie['id'] for axie in self.request_handler.decode(r, '_items')]
 
     def get_axies(self, axie_ids: list = None):
         """ Get Axies from axie ids.
@@ -62,11 +66,13 @@ class AxieUser:
             return [Axie(axie_id) for axie_id in axie_ids]
 
 
-    def get_min_axie_prices(self, axies: list = []):
+    def get_min_axie_prices(self, axies: list = [], observations: list = None):
         """ Get minimum market praces for twin axies
 
         :param axies: list of axies for price check
-        :return: list of dicts {id, id_twin, price} for player axies
+        :param observations: list to append build observations for PriceHistory.record_many, None for no recording.
+                             Builds without listings are recorded with price None and depth 0
+        :return: list of dicts {id, id_twin, price, depth} for player axies
         """
         if axies == None:
             return None
@@ -75,14 +81,19 @@ class AxieUser:
         out = list()
         for axie in axies:
             twin = axie.get_twins(size=1)
+            if observations is not None:
+                observations.append(('build', axie.build_signature, float(twin['price']) if twin else None,
+                                     axie.twins_total if twin else 0, int(time.time())))
             if twin:
                 out.append({'id': axie.axie_id,
                             'id_twin': twin['id'],
-                            'price': float(twin['price'])})
+                            'price': float(twin['price']),
+                            'depth': axie.twins_total})
             else:
                 out.append({'id': axie.axie_id,
                             'id_twin': None,
-                            'price': None})
+                            'price': None,
+                            'depth': 0})
         return out
 
     def get_battle_history(self, number_of_games: int = 10):
@@ -102,45 +113,109 @@ class AxieUser:
             'limit': number_of_games,
         }
         r = self.request_handler.getRequest(url, params, headers, error_log=f"GetBattleHistory({self.user_id}) ")
-        self.battles = json.loads(r.text)['battles']
+        self.battles = self.request_handler.decode(r, 'battles')
         return self.battles
 
     @staticmethod
-    def get_leaderboard(number_of_places: int = 100, offset: int = 1, request_capacity: int = None):
+    def get_leaderboard(number_of_places: int = 100,
+                        offset: int = 1,
+                        request_capacity: int = None,
+                        max_workers: int = 8,
+                        checkpoint: str = None,
+                        checkpoint_max_age: int = 3600,
+                        cache_ttl: int = 300):
         """ Get Player ids from leaderboard
 
            :param number_of_places: number of ranks to be returned
-           :param first_rank: rank offset
+           :param offset: rank offset
            :param request_capacity: number of places in one request. if None, request_capasity:
-           :return: list of tuples ('userID', 'rank')
+           :param max_workers: number of pages requested concurrently
+           :param checkpoint: json file to save fetched pages of an unfinished run in, rerun only requests
+                              missing pages. Removed when all pages are fetched
+           :param checkpoint_max_age: seconds checkpoint pages are reused for, older pages are requested again
+           :param cache_ttl: seconds fetched pages are reused for in memory
+           :return: list of tuples (rank, userID) in rank order, ranks of failed pages are missing
            """
         if request_capacity is None:
             if number_of_places >= 100:
                 request_capacity = 100
             else:
                 request_capacity = number_of_places
-        leaders = list()
         url = "https://api-gateway.skymavis.com/origin/v2/leaderboards"
         headers = {
             "accept": "application/json",
             "X-API-Key": api_token
         }
-        for batch_of_places in range(offset, offset + number_of_places, request_capacity):
+        now = time.time()
+        for page in [page for page, (fetched, _) in AxieUser.leaderboard_cache.items() if now - fetched >= cache_ttl]:
+            del AxieUser.leaderboard_cache[page]
+        pages = [(batch_of_places, request_capacity)
+                 for batch_of_places in range(offset, offset + number_of_places, request_capacity)]
+        batches = AxieUser.load_leaderboard_checkpoint(checkpoint, checkpoint_max_age) if checkpoint else dict()
+        batches.update({page: AxieUser.leaderboard_cache[page]
+                        for page in pages if page in AxieUser.leaderboard_cache and page not in batches})
+        request_handler = RequestHandler(max_retries=3)
+
+        def get_page(page):
             params = {
-                'limit': request_capacity,
-                'offset': batch_of_places
+                'limit': page[1],
+                'offset': page[0]
             }
             try:
-                r = requests.get(url, headers=headers, params=params)
-                if r.status_code != 200:
-                    logging.info(f"Get leaderboard error: {r.status_code}")
-                    return None
-            except requests.exceptions.RequestException as error:
-                logging.info(f"Leaderboard can't be accessed due to: {error}.")
+                r = request_handler.getRequest(url, params, headers, error_log=f"GetLeaderboard({page[0]}) ")
+                leaders = [(leader['topRank'], leader['userID']) for leader in request_handler.decode(r, '_items')]
+            except Exception as error:
+                logging.info(f"Leaderboard page {page[0]} can't be accessed due to: {error}.")
                 return None
+            AxieUser.leaderboard_cache[page] = (time.time(), leaders)
+            return AxieUser.leaderboard_cache[page]
+
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        futures = {executor.submit(get_page, page): page for page in pages if page not in batches}
+        try:
+            for _ in as_completed(futures):
+                pass
+        finally:  # On interrupt cancel queued pages and save the ones already fetched
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=False)
+            batches.update({page: future.result() for future, page in futures.items()
+                            if future.done() and not future.cancelled() and future.exception() is None
+                            and future.result() is not None})
+            missing = [page for page in pages if page not in batches]
+            if checkpoint and missing:
+                with open(checkpoint + '.tmp', 'w') as file:
+                    json.dump({json.dumps(page): batches[page] for page in pages if page in batches}, file)
+                os.replace(checkpoint + '.tmp', checkpoint)
+            elif checkpoint and os.path.exists(checkpoint):
+                os.remove(checkpoint)
+        for page_offset, limit in missing:
+            logging.info(f"Leaderboard ranks {page_offset}-{page_offset + limit - 1} are missing.")
+        return [leader for page in pages if page in batches for leader in batches[page][1]]
+
+    @staticmethod
+    def load_leaderboard_checkpoint(checkpoint: str, max_age: int):
+        """ Load leaderboard pages saved by get_leaderboard
 
-            leaders.extend([(leader['topRank'], leader['userID']) for leader in json.loads(r.text)['_items']])
-        return leaders
+        :param checkpoint: json checkpoint file
+        :param max_age: seconds pages are reused for
+        :return: dict {(offset, limit): (fetch time, [(rank, userID)...])}, empty for no or broken checkpoint
+        """
+        if not os.path.exists(checkpoint):
+            return dict()
+        try:
+            with open(checkpoint) as file:
+                saved = {tuple(json.loads(page)): (fetched, [tuple(leader) for leader in leaders])
+                         for page, (fetched, leaders) in json.load(file).items()}
+        except (ValueError, TypeError, AttributeError) as error:
+            logging.info(f"Leaderboard checkpoint {checkpoint} can't be read due to: {error}.")
+            return dict()
+        now = time.time()
+        expired = [page for page, (fetched, _) in saved.items() if now - fetched >= max_age]
+        if expired:
+            logging.info(f"Leaderboard checkpoint {checkpoint}: {len(expired)} pages older than {max_age} s "
+                          f"are requested again.")
+        return {page: batch for page, batch in saved.items() if page not in expired}
 
 
     def get_active_team(self):
@@ -172,17 +247,26 @@ class AxieUser:
 
 
 
-    def get_team_price(self):
+    def get_team_price(self, observations: list = None):
         """ Get price of an active team
 
+        :param observations: list to append build and team observations for PriceHistory.record_many,
+                             None for no recording
         :return: {price, axie_ids}
         """
-        team_info = self.get_min_axie_prices(axies=self.active_team)
+        team_info = self.get_min_axie_prices(axies=self.active_team, observations=observations)
         if team_info == None:
             return None
         if any(data['price'] is None for data in team_info):  # Check if there is a None value (no twin axie)
+            if observations is not None:
+                observations.append(('team', team_signature([axie.build_signature for axie in self.active_team]),
+                                     None, 0, int(time.time())))
             return None
-        return {'price': round(sum([axie['price'] for axie in team_info], 2)),
+        price = round(sum([axie['price'] for axie in team_info]), 2)
+        if observations is not None:  # Team depth is limited by the rarest build
+            observations.append(('team', team_signature([axie.build_signature for axie in self.active_team]),
+                                 price, min([axie['depth'] for axie in team_info]), int(time.time())))
+        return {'price': price,
                 'twin_id1': team_info[0]['id_twin'],
                 'twin_id2': team_info[1]['id_twin'],
                 'twin_id3': team_info[2]['id_twin']}
@@ -192,28 +276,40 @@ class AxieUser:
     def get_leaderboard_team_prices(number_of_places: int = 100,
                                     offset: int = 1,
                                     request_capacity: int = None,
-                                    log_output: bool = False):
+                                    log_output: bool = False,
+                                    price_history: PriceHistory = None,
+                                    max_workers: int = 8,
+                                    checkpoint: str = None):
         """ Return prices of teams (where twins exist) in a leaderboard
 
         :param log_output: True if write output in logfile INFO level
+        :param max_workers: number of leaderboard pages requested concurrently
+        :param checkpoint: json file for leaderboard pages of an unfinished run, see get_leaderboard
+        :param price_history: PriceHistory to record build and team prices in (once per scan), None for no recording
         :return: list of dicts {rank, [axie_ids], price}
         """
-        leaderboard = AxieUser.get_leaderboard(number_of_places, offset, request_capacity)
+        leaderboard = AxieUser.get_leaderboard(number_of_places, offset, request_capacity,
+                                               max_workers=max_workers, checkpoint=checkpoint)
         leader_prices = list()
-        for rank, user_id in leaderboard:
-            user = AxieUser(user_id, axie_ids=[])
-            try:
-                user.leaderboard_update()
-            except (requests.exceptions.RetryError, TypeError):
-                continue
-            team_info = user.get_team_price()
-            if team_info is None:
-                continue
-            if log_output:
-                logging.info(f"Team_rank: {rank} :: axie_ids:"
-                             f" {team_info['twin_id1']}|{team_info['twin_id2']}|{team_info['twin_id3']} "
-                             f":: Price: {team_info['price']}")
-            leader_prices.append({'rank': rank, **team_info})
+        observations = list() if price_history else None
+        try:
+            for rank, user_id in leaderboard:
+                user = AxieUser(user_id, axie_ids=[])
+                try:
+                    user.leaderboard_update()
+                except (requests.exceptions.RetryError, TypeError):
+                    continue
+                team_info = user.get_team_price(observations=observations)
+                if team_info is None:
+                    continue
+                if log_output:
+                    logging.info(f"Team_rank: {rank} :: axie_ids:"
+                                 f" {team_info['twin_id1']}|{team_info['twin_id2']}|{team_info['twin_id3']} "
+                                 f":: Price: {team_info['price']}")
+                leader_prices.append({'rank': rank, **team_info})
+        finally:  # Keep observations of an interrupted scan
+            if observations:
+                price_history.record_many(observations)
         return leader_prices
 
     def leaderboard_update(self):
@@ -236,8 +332,11 @@ class Axie:
         self.axie_genes = self.get_genes()
         self.axie_class, self.axie_parts = self.retrieve_parts_from_genes()
 
+        self.build_signature = build_signature(self.axie_class, self.axie_parts) if self.axie_parts else None
+
         # Consuming operation
         self.twins = None  # get_twins()
+        self.twins_total = None
 
     def get_genes(self):
         """ Get genes from axie_id
@@ -249,10 +348,10 @@ class Axie:
             "variables": {
                 "axieId": self.axie_id
             },
-            "query": "query GetAxieDetail($axieId: ID!) {\n  axie(axieId: $axieId) {\n    ...AxieDetail\n    __typename\n  }\n}\n\nfragment AxieDetail on Axie {\n  id\n  image\n  class\n  chain\n  name\n  genes\n  newGenes\n  owner\n  birthDate\n  bodyShape\n  class\n  sireId\n  sireClass\n  matronId\n  matronClass\n  stage\n  title\n  breedCount\n  level\n  figure {\n    atlas\n    model\n    image\n    __typename\n  }\n  parts {\n    ...AxiePart\n    __typename\n  }\n  stats {\n    ...AxieStats\n    __typename\n  }\n  order {\n    ...OrderInfo\n    __typename\n  }\n  ownerProfile {\n    name\n    __typename\n  }\n  battleInfo {\n    ...AxieBattleInfo\n    __typename\n  }\n  children {\n    id\n    name\n    class\n    image\n    title\n    stage\n    __typename\n  }\n  potentialPoints {\n    beast\n    aquatic\n    plant\n    bug\n    bird\n    reptile\n    mech\n    dawn\n    dusk\n    __typename\n  }\n  equipmentInstances {\n    ...EquipmentInstance\n    __typename\n  }\n  __typename\n}\n\nfragment AxieBattleInfo on AxieBattleInfo {\n  banned\n  banUntil\n  level\n  __typename\n}\n\nfragment AxiePart on AxiePart {\n  id\n  name\n  class\n  type\n  specialGenes\n  stage\n  abilities {\n    ...AxieCardAbility\n    __typename\n  }\n  __typename\n}\n\nfragment AxieCardAbility on AxieCardAbility {\n  id\n  name\n  attack\n  defense\n  energy\n  description\n  backgroundUrl\n  effectIconUrl\n  __typename\n}\n\nfragment AxieStats on AxieStats {\n  hp\n  speed\n  skill\n  morale\n  __typename\n}\n\nfragment OrderInfo on Order {\n  id\n  maker\n  kind\n  assets {\n    ...AssetInfo\n    __typename\n  }\n  expiredAt\n  paymentToken\n  startedAt\n  basePrice\n  endedAt\n  endedPrice\n  expectedState\n  nonce\n  marketFeePercentage\n  signature\n  hash\n  duration\n  timeLeft\n  currentPrice\n  suggestedPrice\n  currentPriceUsd\n  __typename\n}\n\nfragment AssetInfo on Asset {\n  erc\n  address\n  id\n  quantity\n  orderId\n  __typename\n}\n\nfragment EquipmentInstance on EquipmentInstance {\n  id: tokenId\n  tokenId\n  owner\n  equipmentId\n  alias\n  equipmentType\n  slot\n  name\n  rarity\n  collections\n  equippedBy\n  __typename\n}\n"
+            "query": "query GetAxieDetail($axieId: ID!) {\n  axie(axieId: $axieId) {\n    id\n    newGenes\n    __typename\n  }\n}\n"
         }
         r = self.request_handler.grapqlRequest(query, error_log=f"getGenes({self.axie_id}) ")
-        return json.loads(r.text)['data']['axie']['newGenes']
+        return self.request_handler.decode(r, 'data', 'axie', 'newGenes')
 
     def retrieve_parts_from_genes(self):
         """ Retrieves information from gene string.
@@ -286,11 +385,12 @@ class Axie:
                     'classes': self.axie_class
                 }
             },
-            "query": "query GetAxieBriefList($auctionType: AuctionType, $criteria: AxieSearchCriteria, $from: Int, $sort: SortBy, $size: Int, $owner: String) {\n  axies(\n    auctionType: $auctionType\n    criteria: $criteria\n    from: $from\n    sort: $sort\n    size: $size\n    owner: $owner\n  ) {\n    total\n    results {\n      ...AxieBrief\n      __typename\n    }\n    __typename\n  }\n}\n\nfragment AxieBrief on Axie {\n  id\n  name\n  stage\n  class\n  breedCount\n  image\n  title\n  genes\n  newGenes\n  battleInfo {\n    banned\n    __typename\n  }\n  order {\n    id\n    currentPrice\n    currentPriceUsd\n    __typename\n  }\n  parts {\n    id\n    name\n    class\n    type\n    specialGenes\n    __typename\n  }\n  __typename\n}\n"
+            "query": "query GetAxieBriefList($auctionType: AuctionType, $criteria: AxieSearchCriteria, $from: Int, $sort: SortBy, $size: Int, $owner: String) {\n  axies(\n    auctionType: $auctionType\n    criteria: $criteria\n    from: $from\n    sort: $sort\n    size: $size\n    owner: $owner\n  ) {\n    total\n    results {\n      id\n      order {\n        currentPriceUsd\n        __typename\n      }\n      __typename\n    }\n    __typename\n  }\n}\n"
         }
 
         r = self.request_handler.grapqlRequest(query, error_log=f"getTwins({self.axie_id}) ")
-        similar_axies_raw = json.loads(r.text)['data']['axies']
+        similar_axies_raw = self.request_handler.decode(r, 'data', 'axies')
+        self.twins_total = similar_axies_raw['total']
         if similar_axies_raw['total'] == 0:
             logging.debug(f"No twin axies acessible on marketplace for id: {self.axie_id}")
             return None
@@ -323,6 +423,7 @@ def cprofile_test():
 
 class RequestHandler():
     marketplace_endpoint = 'https://graphql-gateway.axieinfinity.com/graphql/'
+    payload_dir = None  # Directory to record response bodies in for decode_benchmark.py, None for no recording
     def __init__(self,max_retries: int = 10):
         """ RequestHandler take all http request used with error logging.
         :param max_retries:
@@ -347,6 +448,7 @@ class RequestHandler():
                 logging.debug(f"{error_log}RequestException {i}: {error}.")
                 continue
             if r.status_code == 200:
+                self.save_payload(r, query['operationName'])
                 return r
             else:
                 error_text += f" last status code {r.status_code}"
@@ -363,6 +465,7 @@ class RequestHandler():
         :param error_log:
         :return: response
         """
+        error_text = f"{error_log}Number of retries exceed."
         for i in range(self.max_retries):
             try:
                 r = requests.get(url, headers=headers, params=params)
@@ -370,12 +473,36 @@ class RequestHandler():
                 logging.debug(f"{error_log}RequestException {i}: {error}")
                 continue
             if r.status_code == 200:
+                self.save_payload(r, url.rstrip('/').split('/')[-1])
                 return r
+            else:
+                error_text += f" last status code {r.status_code}"
             time.sleep(0.1)
-        error_text = f"{error_log}Number of retries exceed. last status code {r.status_code}"
         logging.debug(error_text)
         raise Exception(error_text)
 
+    def save_payload(self, r, name: str):
+        """ Save response body in payload_dir if set
+
+        :param r: response
+        :param name: payload file name prefix
+        """
+        if self.payload_dir is None:
+            return
+        os.makedirs(self.payload_dir, exist_ok=True)
+        with open(os.path.join(self.payload_dir, f"{name}_{time.time_ns()}.json"), 'wb') as payload:
+            payload.write(r.content)
+
+    @staticmethod
+    def decode(r, *keys):
+        """ Decode json response straight from bytes (orjson if installed)
+
+        :param r: response
+        :param keys: path of keys to the needed part of response
+        :return: decoded json part
+        """
+        return tools.decode_json(r.content, *keys)
+
 
 
 
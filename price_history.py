@@ -0,0 +1,157 @@
+import sqlite3
+import statistics
+import time
+from collections import defaultdict
+import pandas as pd
+
+resolutions = {'hour': 3600, 'day': 86400}
+rollup_columns = ['bucket', 'min_price', 'median_price', 'median_depth', 'observations']
+
+
+def build_signature(axie_class: str, axie_parts: dict):
+    """ Build signature of an axie, same for all twins
+
+    :param axie_class: axie class
+    :param axie_parts: dict of axie part_ids
+    :return: str 'class:part1|part2...'
+    """
+    return f"{axie_class}:{'|'.join(sorted(axie_parts.values()))}"
+
+
+def team_signature(build_signatures: list):
+    """ Team signature from build signatures, independent of axie order
+
+    :param build_signatures: list of build signatures
+    :return: str 'build1/build2/build3'
+    """
+    return '/'.join(sorted(build_signatures))
+
+
+def rollup(bucket: int, rows: list):
+    """ Rollup of one bucket
+
+    :param bucket: bucket start, unix time
+    :param rows: list of tuples (price, depth), price None for no listings
+    :return: tuple (bucket, min_price, median_price, median_depth, observations),
+             prices None if there were no listings in the bucket
+    """
+    prices = [price for price, _ in rows if price is not None]
+    depths = [depth for _, depth in rows]
+    if not prices:
+        return bucket, None, None, statistics.median(depths), len(rows)
+    return bucket, min(prices), statistics.median(prices), statistics.median(depths), len(rows)
+
+
+class PriceHistory:
+
+    def __init__(self, db_name: str = 'price_history.db'):
+        """ Append-only price store with hourly and daily min/median rollups.
+
+        Buckets are rolled up once, when a later observation of the same key closes them.
+        The open (latest) bucket of a key is computed from observations on query.
+
+        :param db_name: sqlite file name, ':memory:' for in memory store
+        """
+        self.connection = sqlite3.connect(db_name)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS observations (
+                kind TEXT, key TEXT, ts INTEGER, price REAL, depth INTEGER);
+            CREATE INDEX IF NOT EXISTS observations_key_ts ON observations (kind, key, ts);
+            CREATE TABLE IF NOT EXISTS rollups (
+                kind TEXT, key TEXT, resolution INTEGER, bucket INTEGER,
+                min_price REAL, median_price REAL, median_depth REAL, observations INTEGER,
+                PRIMARY KEY (kind, key, resolution, bucket));
+            CREATE TABLE IF NOT EXISTS open_buckets (
+                kind TEXT, key TEXT, resolution INTEGER, bucket INTEGER,
+                PRIMARY KEY (kind, key, resolution));
+        """)
+
+    def record(self, kind: str, key: str, price: float, depth: int, ts: int = None):
+        """ Append one observation, use record_many for a scan
+
+        :param kind: 'build' or 'team'
+        :param key: build or team signature
+        :param price: cheapest price, None for no listings
+        :param depth: number of listings
+        :param ts: unix time, None for now
+        """
+        self.record_many([(kind, key, price, depth, ts)])
+
+    def record_many(self, observations: list):
+        """ Append observations in one transaction and roll up buckets they close
+
+        :param observations: list of tuples (kind, key, price, depth, ts)
+        """
+        now = int(time.time())
+        rows = [(kind, key, int(now if ts is None else ts), price, depth)
+                for kind, key, price, depth, ts in observations]
+        timestamps = defaultdict(list)
+        for kind, key, ts, _, _ in rows:
+            timestamps[(kind, key)].append(ts)
+        with self.connection:
+            self.connection.executemany("INSERT INTO observations VALUES (?, ?, ?, ?, ?)", rows)
+            for (kind, key), key_timestamps in timestamps.items():
+                for resolution in resolutions.values():
+                    self._close_buckets(kind, key, resolution, {ts - ts % resolution for ts in key_timestamps})
+
+    def _close_buckets(self, kind: str, key: str, resolution: int, buckets: set):
+        opened = self.connection.execute(
+            "SELECT bucket FROM open_buckets WHERE kind = ? AND key = ? AND resolution = ?",
+            (kind, key, resolution)).fetchone()
+        newest = max(buckets)
+        if opened is None:
+            first = min(buckets)
+        else:
+            first = opened[0]
+            for bucket in buckets:  # Late observations change already closed buckets
+                if bucket < first:
+                    self._rollup(kind, key, resolution, bucket, bucket + resolution)
+        if newest > first:
+            self._rollup(kind, key, resolution, first, newest)
+        self.connection.execute("INSERT OR REPLACE INTO open_buckets VALUES (?, ?, ?, ?)",
+                                (kind, key, resolution, max(first, newest)))
+
+    def _rollup(self, kind: str, key: str, resolution: int, start: int, end: int):
+        buckets = defaultdict(list)
+        for ts, price, depth in self._observations(kind, key, start, end):
+            buckets[ts - ts % resolution].append((price, depth))
+        self.connection.executemany("INSERT OR REPLACE INTO rollups VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                    [(kind, key, resolution, *rollup(bucket, bucket_rows))
+                                     for bucket, bucket_rows in buckets.items()])
+
+    def _observations(self, kind: str, key: str, start: int, end: int):
+        return self.connection.execute(
+            "SELECT ts, price, depth FROM observations WHERE kind = ? AND key = ? AND ts >= ? AND ts < ? "
+            "ORDER BY ts", (kind, key, start, end)).fetchall()
+
+    def history(self, kind: str, key: str, start: int = None, end: int = None, resolution: str = 'hour'):
+        """ Price history of a build or team
+
+        :param kind: 'build' or 'team'
+        :param key: build or team signature
+        :param start: unix time from (included), None for no limit
+        :param end: unix time to (excluded), None for no limit
+        :param resolution: 'raw', 'hour' or 'day'
+        :return: pandas dataframe, {ts, price, depth} for raw,
+                 {bucket, min_price, median_price, median_depth, observations} for rollups
+        """
+        start = 0 if start is None else start
+        end = 2 ** 62 if end is None else end
+        if resolution == 'raw':
+            return pd.DataFrame(self._observations(kind, key, start, end), columns=['ts', 'price', 'depth'])
+        resolution = resolutions[resolution]
+        rows = self.connection.execute(
+            "SELECT bucket, min_price, median_price, median_depth, observations FROM rollups "
+            "WHERE kind = ? AND key = ? AND resolution = ? AND bucket >= ? AND bucket < ? ORDER BY bucket",
+            (kind, key, resolution, start, end)).fetchall()
+        opened = self.connection.execute(
+            "SELECT bucket FROM open_buckets WHERE kind = ? AND key = ? AND resolution = ?",
+            (kind, key, resolution)).fetchone()
+        if opened and start <= opened[0] < end:
+            open_rows = [(price, depth) for _, price, depth in
+                         self._observations(kind, key, opened[0], opened[0] + resolution)]
+            rows.append(rollup(opened[0], open_rows))
+        return pd.DataFrame(rows, columns=rollup_columns)
+
+    def close(self):
+        self.connection.close()
@@ -1,5 +1,10 @@
 import pandas as pd
 import re
+import json
+try:
+    import orjson  # Optional faster json backend
+except ImportError:
+    orjson = None
 
 def get_team_from_logs(log_name: str = 'logs.log', save_name: str = None):
     """ Create pandas dataframe from logs saved
@@ -28,6 +33,18 @@ def get_team_from_logs(log_name: str = 'logs.log', save_name: str = None):
         df.to_excel(save_name)
     return df
 
+def decode_json(content: bytes, *keys):
+    """ Decode json from bytes (orjson if installed) and take the needed part
+
+    :param content: raw json bytes
+    :param keys: path of keys to the needed part
+    :return: decoded json part
+    """
+    data = orjson.loads(content) if orjson else json.loads(content)
+    for key in keys:
+        data = data[key]
+    return data
+
 def erase_log(filename: str = 'logs_rework.log'):
     open(filename, 'w').close()
 if __name__ == '__tools__':